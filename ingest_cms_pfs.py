@@ -1,6 +1,12 @@
 # scripts/ingest_cms_pfs.py
 
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+import csv
+import itertools
 import os
 import sys
 
@@ -14,22 +20,82 @@ CONVERSION_FACTOR = 32.3465  # The final 2025 Conversion Factor
 SOURCE_FILE_PATH = r'C:\bill_parser\source_data\rvu25d_0\PPRRVU2025_Oct.csv'
 # In scripts/ingest_cms_pfs.py
 OUTPUT_FILE_PATH =r'C:\bill_parser\cpt_pricing_data.csv.csv'
+# Parquet sidecar next to the CSV, under the file name parser.py loads (PRICING_PARQUET_PATH there).
+PRICING_PARQUET_PATH = os.path.join(os.path.dirname(OUTPUT_FILE_PATH), 'cpt_pricing_data.parquet')
+HEADER_SCAN_CHUNK_SIZE = 64 * 1024  # Bytes read per block while searching for the header row
 def find_header_row(file_path, keyword='HCPCS'):
     """
     Scans a CSV file to find the first row containing a specific keyword (like 'HCPCS').
     This is used to automatically skip junk header lines.
     Returns the row number (0-indexed).
     """
+    needle = keyword.encode('latin1')
+    overlap = len(needle) - 1
     try:
-        with open(file_path, 'r', encoding='latin1') as f:
-            for i, line in enumerate(f):
-                if keyword in line:
-                    print(f"Found correct header at row number: {i}")
-                    return i
+        # Scan the raw bytes in fixed-size blocks; bytes.find/count run in C instead
+        # of decoding and dispatching every junk preamble line in Python.
+        with open(file_path, 'rb') as f:
+            lines_before = 0
+            carry = b''
+            while True:
+                chunk = f.read(HEADER_SCAN_CHUNK_SIZE)
+                if not chunk:
+                    break
+                buf = carry + chunk
+                idx = buf.find(needle)
+                if idx >= 0:
+                    row = lines_before + buf.count(b'\n', 0, idx)
+                    print(f"Found correct header at row number: {row}")
+                    return row
+                # Carry the tail over so a keyword split across two blocks is still found.
+                split = len(buf) - overlap
+                lines_before += buf.count(b'\n', 0, split)
+                carry = buf[split:]
     except Exception as e:
         print(f"Error while trying to find header row: {e}")
     return None
 
+def read_header_columns(file_path, header_row_index):
+    """
+    Reads the header row and returns its column names, stripped and with duplicate
+    names suffixed ('RVU', 'RVU.1', ...) exactly the way pandas would name them.
+    """
+    with open(file_path, 'r', encoding='latin1', newline='') as f:
+        header = next(itertools.islice(csv.reader(f), header_row_index, None))
+
+    column_names = []
+    seen_counts = {}
+    for name in (col.strip() for col in header):
+        count = seen_counts.get(name, 0)
+        seen_counts[name] = count + 1
+        column_names.append(f"{name}.{count}" if count else name)
+    return column_names
+
+def read_rvu_table(column_names, header_row_index, required_columns, rvu_type):
+    """
+    Reads the required columns of the RVU file with PyArrow: HCPCS as text and the RVU
+    components (every other required column) as `rvu_type`.
+    """
+    column_types = {col: rvu_type for col in required_columns}
+    column_types['HCPCS'] = pa.string()
+    return pacsv.read_csv(
+        SOURCE_FILE_PATH,
+        read_options=pacsv.ReadOptions(
+            skip_rows=header_row_index + 1,
+            column_names=column_names,
+            encoding='latin1'
+        ),
+        # Rows with the wrong number of columns (e.g. footer notes) are skipped, as pandas
+        # effectively did by leaving them without a code/RVU values.
+        parse_options=pacsv.ParseOptions(delimiter=',', invalid_row_handler=lambda row: 'skip'),
+        convert_options=pacsv.ConvertOptions(
+            include_columns=required_columns,
+            column_types=column_types,
+            null_values=['', 'NA', 'N/A'],
+            strings_can_be_null=True
+        )
+    )
+
 def process_pfs_data_manually():
     """
     Reads the preliminary CMS RVU file, manually calculates the non-facility price,
@@ -44,57 +110,82 @@ def process_pfs_data_manually():
         print(f"FATAL ERROR: Could not find the mandatory 'HCPCS' keyword in any row of the file.")
         return
 
-    try:
-        df = pd.read_csv(SOURCE_FILE_PATH, encoding='latin1', header=header_row_index, low_memory=False)
-    except FileNotFoundError:
-        print(f"FATAL ERROR: Source file not found at {SOURCE_FILE_PATH}")
-        return
-
-    print("Source data loaded successfully, skipping junk headers. Processing...")
-
-    df.columns = df.columns.str.strip()
-    
     # --- THIS IS THE CRITICAL FIX ---
     # Use the exact, but poorly named, columns from the actual file header.
     # Mapping: WORK RVU -> 'RVU', NON-FAC PE RVU -> 'PE RVU', NON-FAC MP RVU -> 'RVU.1'
     required_rvu_columns = ['HCPCS', 'RVU', 'PE RVU', 'RVU.1']
-    
-    if not all(col in df.columns for col in required_rvu_columns):
+
+    column_names = read_header_columns(SOURCE_FILE_PATH, header_row_index)
+    if not all(col in column_names for col in required_rvu_columns):
         print(f"FATAL ERROR: The source file is missing one of the required RVU component columns.")
         print(f"Expected columns: {required_rvu_columns}")
-        print(f"Available columns are: {df.columns.tolist()}")
+        print(f"Available columns are: {column_names}")
         return
 
-    df_clean = df[required_rvu_columns].copy()
-    
-    # Convert the correctly-named RVU columns to numeric
-    for col in ['RVU', 'PE RVU', 'RVU.1']:
-        df_clean[col] = pd.to_numeric(df_clean[col], errors='coerce')
-    
-    df_clean.dropna(inplace=True)
-
-    # Perform the core calculation using the correct column names
-    df_clean['total_non_facility_rvu'] = df_clean['RVU'] + df_clean['PE RVU'] + df_clean['RVU.1']
-    df_clean['calculated_price'] = (df_clean['total_non_facility_rvu'] * CONVERSION_FACTOR).round(2)
-    
-    df_clean = df_clean[df_clean['calculated_price'] > 0]
-    
-    if len(df_clean) == 0:
+    # PyArrow parses the file in multithreaded C++ and yields typed columns directly,
+    # so the RVU columns arrive as float64 without a separate to_numeric pass.
+    rvu_columns_are_text = False
+    try:
+        table = read_rvu_table(column_names, header_row_index, required_rvu_columns, pa.float64())
+    except FileNotFoundError:
+        print(f"FATAL ERROR: Source file not found at {SOURCE_FILE_PATH}")
+        return
+    except pa.ArrowInvalid as e:
+        # A non-numeric cell (e.g. 'NC') fails the typed read. Re-read the RVU columns as
+        # text and coerce them below, so bad cells become NaN and are dropped as before.
+        print(f"WARNING: Non-numeric RVU values found ({e}). Re-reading RVU columns as text.")
+        try:
+            table = read_rvu_table(column_names, header_row_index, required_rvu_columns, pa.string())
+            rvu_columns_are_text = True
+        except pa.ArrowInvalid as e:
+            print(f"FATAL ERROR: Could not parse the source file. Error: {e}")
+            return
+
+    print("Source data loaded successfully, skipping junk headers. Processing...")
+
+    # include_columns already restricts the table to the typed RVU columns, so the
+    # converted frame can be used directly without re-selecting and copying them.
+    df_clean = table.to_pandas()
+    if rvu_columns_are_text:
+        for col in required_rvu_columns[1:]:
+            df_clean[col] = pd.to_numeric(df_clean[col], errors='coerce')
+
+    # Perform the core calculation on the raw NumPy arrays so that no intermediate
+    # DataFrame copies are made; the output frame is built once at the end.
+    hcpcs = df_clean['HCPCS'].to_numpy()
+    total_non_facility_rvu = (
+        df_clean['RVU'].to_numpy() + df_clean['PE RVU'].to_numpy() + df_clean['RVU.1'].to_numpy()
+    )
+    calculated_price = np.round(total_non_facility_rvu * CONVERSION_FACTOR, 2)
+
+    # Skip rows with a missing code or RVU component, and any non-positive price.
+    valid_rows = df_clean['HCPCS'].notna().to_numpy() & np.isfinite(total_non_facility_rvu) & (calculated_price > 0)
+
+    if not valid_rows.any():
         print("FATAL ERROR: No rows with a positive calculated price were found.")
         return
 
+    cpt_codes = np.char.strip(hcpcs[valid_rows].astype(str))
+    median_prices = calculated_price[valid_rows]
+
+    # Keep the first row for each code: np.unique returns each code's first index,
+    # and sorting those indices restores the original file order.
+    _, first_idx = np.unique(cpt_codes, return_index=True)
+    first_idx.sort()
+
     # Finalize the DataFrame for our application
-    final_df = df_clean[['HCPCS', 'calculated_price']].rename(columns={
-        'HCPCS': 'cpt_code',
-        'calculated_price': 'median_price'
+    final_df = pd.DataFrame({
+        'cpt_code': cpt_codes[first_idx],
+        'median_price': median_prices[first_idx]
     })
 
-    final_df['cpt_code'] = final_df['cpt_code'].astype(str).str.strip()
-    final_df.drop_duplicates(subset=['cpt_code'], keep='first', inplace=True)
-
     # Save the output file
     try:
-        final_df.to_csv(OUTPUT_FILE_PATH, index=False)
+        # PyArrow's multithreaded C++ writer avoids pandas' per-value Python formatting.
+        table = pa.Table.from_pandas(final_df, preserve_index=False)
+        pacsv.write_csv(table, OUTPUT_FILE_PATH, write_options=pacsv.WriteOptions(include_header=True))
+        # Also write a Parquet copy; the app loads it at startup instead of re-parsing the CSV.
+        pq.write_table(table, PRICING_PARQUET_PATH)
         print(f"Successfully calculated and saved {len(final_df)} unique records.")
         print(f"Application knowledge base is now up-to-date: {OUTPUT_FILE_PATH}")
     except Exception as e:
@@ -1,6 +1,8 @@
 # llm_service.py
 import httpx
 import json
+from collections import OrderedDict
+from typing import AsyncGenerator
 from fastapi import HTTPException
 
 # Import the API key from our config file
@@ -10,10 +12,24 @@ from config import TOGETHER_API_KEY
 LLM_MODEL = "meta-llama/Llama-3-70b-chat-hf"
 TOGETHER_API_URL = "https://api.together.xyz/v1/chat/completions"
 
-async def get_llm_response(prompt: str, system_prompt: str) -> str:
+# One long-lived client for the whole process. Creating a client per call meant a
+# fresh TCP/TLS handshake on every LLM request.
+_HTTP_CLIENT = httpx.AsyncClient(timeout=30.0, limits=httpx.Limits(max_keepalive_connections=20))
+
+# Completed responses keyed by the exact (system prompt, prompt) pair, least recently used
+# first. The prompt embeds the full bill JSON, so a hit is always the very same request
+# (e.g. the same bill explained twice) and never another patient's answer.
+LLM_RESPONSE_CACHE_SIZE = 128
+_RESPONSE_CACHE: OrderedDict[tuple[str, str], str] = OrderedDict()
+
+async def close_llm_client() -> None:
+    """Closes the shared HTTP client. Call once on application shutdown."""
+    await _HTTP_CLIENT.aclose()
+
+def build_llm_request(prompt: str, system_prompt: str, stream: bool = False) -> tuple[dict, dict]:
     """
-    Sends a prompt to the Together.ai API and returns the response.
-    This function is asynchronous and includes robust error handling.
+    Builds the headers and JSON payload for a chat completion request.
+    Shared by the blocking and the streaming call so both use identical settings.
     """
     if not TOGETHER_API_KEY:
         raise HTTPException(status_code=500, detail="TOGETHER_API_KEY is not configured on the server.")
@@ -31,34 +47,84 @@ async def get_llm_response(prompt: str, system_prompt: str) -> str:
         ],
         "max_tokens": 2048, # Limit the output length
         "temperature": 0.1, # Low temperature for factual, less creative output
+        "stream": stream, # Server-sent events, one delta per token batch
     }
+    return headers, payload
+
+def llm_error_to_http_exception(error: Exception) -> HTTPException:
+    """Maps a transport, status, or parsing error from the LLM call to the API's HTTPException."""
+    if isinstance(error, httpx.TimeoutException):
+        return HTTPException(status_code=504, detail="Request to LLM service timed out.")
+    if isinstance(error, httpx.RequestError):
+        return HTTPException(status_code=503, detail=f"Could not connect to LLM service: {error}")
+    if isinstance(error, httpx.HTTPStatusError):
+        # Provide more specific error details if possible
+        error_detail = f"LLM service returned an error: {error.response.status_code}."
+        if error.response.status_code == 401:
+            error_detail += " Please check the API key."
+        return HTTPException(status_code=502, detail=error_detail)
+    return HTTPException(status_code=500, detail="Failed to parse a valid response from the LLM service.")
+
+LLM_CALL_ERRORS = (httpx.RequestError, httpx.HTTPStatusError, json.JSONDecodeError, IndexError, KeyError)
+
+async def get_llm_response(prompt: str, system_prompt: str) -> str:
+    """
+    Sends a prompt to the Together.ai API and returns the response.
+    This function is asynchronous and includes robust error handling.
+    """
+    cache_key = (system_prompt, prompt)
+    cached = _RESPONSE_CACHE.get(cache_key)
+    if cached is not None:
+        _RESPONSE_CACHE.move_to_end(cache_key)
+        return cached
+
+    headers, payload = build_llm_request(prompt, system_prompt)
+
+    # Reuse the shared client so the TCP/TLS connection stays warm across requests
+    try:
+        response = await _HTTP_CLIENT.post(TOGETHER_API_URL, headers=headers, json=payload)
+        
+        # Raise an exception for bad status codes (4xx or 5xx)
+        response.raise_for_status()
+
+        response_data = response.json()
+        # Extract the text content from the first choice in the response
+        content = response_data.get("choices", [{}])[0].get("message", {}).get("content", "")
+        
+        if not content:
+            raise HTTPException(status_code=500, detail="LLM returned an empty response.")
+        
+        content = content.strip()
+        _RESPONSE_CACHE[cache_key] = content
+        if len(_RESPONSE_CACHE) > LLM_RESPONSE_CACHE_SIZE:
+            _RESPONSE_CACHE.popitem(last=False)
+        return content
 
-    # Use an async client with a timeout
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        try:
-            response = await client.post(TOGETHER_API_URL, headers=headers, json=payload)
-            
-            # Raise an exception for bad status codes (4xx or 5xx)
+    except LLM_CALL_ERRORS as e:
+        raise llm_error_to_http_exception(e)
+
+async def get_llm_response_stream(prompt: str, system_prompt: str) -> AsyncGenerator[str, None]:
+    """
+    Streams the response from the Together.ai API, yielding text deltas as soon as
+    they are generated instead of waiting for the full completion.
+    Errors are raised as the same HTTPExceptions as get_llm_response.
+    """
+    headers, payload = build_llm_request(prompt, system_prompt, stream=True)
+
+    try:
+        async with _HTTP_CLIENT.stream("POST", TOGETHER_API_URL, headers=headers, json=payload) as response:
             response.raise_for_status()
 
-            response_data = response.json()
-            # Extract the text content from the first choice in the response
-            content = response_data.get("choices", [{}])[0].get("message", {}).get("content", "")
-            
-            if not content:
-                raise HTTPException(status_code=500, detail="LLM returned an empty response.")
-            
-            return content.strip()
-
-        except httpx.TimeoutException:
-            raise HTTPException(status_code=504, detail="Request to LLM service timed out.")
-        except httpx.RequestError as e:
-            raise HTTPException(status_code=503, detail=f"Could not connect to LLM service: {e}")
-        except httpx.HTTPStatusError as e:
-            # Provide more specific error details if possible
-            error_detail = f"LLM service returned an error: {e.response.status_code}."
-            if e.response.status_code == 401:
-                error_detail += " Please check the API key."
-            raise HTTPException(status_code=502, detail=error_detail)
-        except (json.JSONDecodeError, IndexError, KeyError):
-            raise HTTPException(status_code=500, detail="Failed to parse a valid response from the LLM service.")
\ No newline at end of file
+            # Each event is a "data: {...}" line; the stream ends with "data: [DONE]".
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    break
+                delta = json.loads(data).get("choices", [{}])[0].get("delta", {}).get("content")
+                if delta:
+                    yield delta
+
+    except LLM_CALL_ERRORS as e:
+        raise llm_error_to_http_exception(e)
\ No newline at end of file
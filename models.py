@@ -1,9 +1,13 @@
 from pydantic import BaseModel, Field
 from typing import List, Optional
 from datetime import date
-import uuid
+import os
 # In models.py
 
+def new_session_id() -> str:
+    """Returns a random 128-bit session ID as 32 hex characters (no UUID object or formatting)."""
+    return os.urandom(16).hex()
+
 class LineItem(BaseModel):
     """Represents a single line item from a bill."""
     cpt_code: Optional[str] = Field(None, description="The CPT code for the service.")
@@ -13,7 +17,7 @@ class LineItem(BaseModel):
     national_average_price: Optional[float] = Field(None, description="The CMS national average price for this service (non-facility).")
 class ParsedBill(BaseModel):
     """Defines the structured JSON output for a parsed bill."""
-    session_id: str = Field(default_factory=lambda: str(uuid.uuid4()), description="Unique ID for this processing session.")
+    session_id: str = Field(default_factory=new_session_id, description="Unique ID for this processing session.")
     provider: Optional[str] = Field(None, description="The name of the medical provider or clinic.")
     patient_name: Optional[str] = Field(None, description="The name of the patient.") # <-- ADD THIS
     claim_id: Optional[str] = Field(None, description="The claim or EOB identification number.") # <-- ADD THIS
@@ -56,6 +60,13 @@ class AppealDraftResponse(BaseModel):
     appeal_draft_text: str
     citations: List[Citation] = []
     flags: List[ValidationFlag] = Field([], description="The final, scored list of flags that were analyzed.") # <-- ADD THIS
+
+class AnalysisResponse(BaseModel):
+    """The combined response for an explanation and an appeal letter generated from one retrieval pass."""
+    explanation_text: str
+    appeal_draft_text: str
+    citations: List[Citation] = []
+    flags: List[ValidationFlag] = Field([], description="The final, scored list of flags that were analyzed.")
 class FlagInput(BaseModel):
     """Represents the raw flag data coming from the validation endpoint."""
     flag_id: str
@@ -1,13 +1,16 @@
 # main.py - Combined, Robust, and Efficient Bill Parser
 
+import asyncio
 import io
 import re
+import sys
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date
-from typing import List, Optional, Dict
+from typing import AsyncGenerator, BinaryIO, List, Optional, Dict
 # In parser.py (at the top)
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, StreamingResponse
 import os
 from google.cloud import vision
 
@@ -19,10 +22,11 @@ from fastapi import FastAPI, File, UploadFile, HTTPException
 from pdf2image import convert_from_bytes
 from PIL import Image, UnidentifiedImageError
 from pydantic import BaseModel, Field
+import numpy as np
 import pandas as pd
 from validator import run_validations
-from models import ParsedBill, ValidationResult, LineItem, ExplanationResponse, AppealDraftResponse, Citation, ValidationFlag
-from llm_service import get_llm_response
+from models import ParsedBill, ValidationResult, LineItem, ExplanationResponse, AppealDraftResponse, AnalysisResponse, Citation, ValidationFlag
+from llm_service import get_llm_response, get_llm_response_stream, close_llm_client
 from prompts import SYSTEM_PROMPT, get_explanation_prompt_with_rag, get_appeal_draft_prompt_with_rag
 from rag_service import rag_service
 from models import ValidationResultInput 
@@ -53,8 +57,22 @@ LINE_ITEM_PATTERN = re.compile(
     r"(\$?[\d,]+\.\d{2})"             # 3: Billed Amount
     , re.IGNORECASE | re.MULTILINE
 )
+# EOB line pattern for statements that may not have CPT codes.
+# It looks for a date, some text, and a price on the same line.
+EOB_LINE_PATTERN = re.compile(
+    r"^(\d{2}/\d{2}/\d{2,4})\s+" # 1: Date
+    r".*?\s+"                      # Intermediate text we don't need
+    r"([\d,]+\.\d{2})"             # 2: Billed Amount (charges)
+    r".*?\s+"                      # More intermediate text
+    r"([\d,]+\.\d{2})$"            # 3: Patient Responsibility for this line
+    , re.MULTILINE
+)
+# Fallback total for plain invoices that don't use EOB wording
+AMOUNT_DUE_PATTERN = re.compile(r"Amount Due[:\s$]*([\d,]+\.\d{2})")
 CPT_PATTERN = re.compile(r"\b(\d{4}[A-Z0-9])\b")
 ICD_PATTERN = re.compile(r"\b([A-TV-Z][0-9][A-Z0-9](?:\.[A-Z0-9]{1,4})?)\b", re.IGNORECASE)
+# Bytes twin of ICD_PATTERN for pure-ASCII text, where byte and Unicode \b / \w agree.
+ICD_BYTES_PATTERN = re.compile(ICD_PATTERN.pattern.encode('ascii'), re.IGNORECASE)
 # =====================================================================================
 # 2. PYDANTIC SCHEMAS (Data Structure)
 # =====================================================================================
@@ -85,6 +103,46 @@ def parse_date_safely(date_str: Optional[str]) -> Optional[date]:
     except (ValueError, TypeError):
         return None
 
+def find_cpt_codes(text: str) -> List[str]:
+    """
+    Finds the unique CPT-style codes in the text (4 digits + a digit/uppercase letter,
+    as a whole word), exactly as CPT_PATTERN does. For ASCII text they are found with a
+    few vectorized NumPy masks over the raw bytes instead of stepping the regex engine.
+    Codes are interned, like the PRICING_DATA keys, so pricing lookups hit on identity.
+    """
+    if not text.isascii():
+        # Accented letters are word characters (and other scripts' digits are \d) for the
+        # str regex; an ASCII byte mask can't reproduce that, so use the regex itself.
+        return list({sys.intern(m.group(1)) for m in CPT_PATTERN.finditer(text)})
+
+    text_bytes = text.encode('ascii')
+    chars = np.frombuffer(text_bytes, dtype=np.uint8)
+    n = chars.size
+    if n < 5:
+        return []
+
+    is_digit = (chars >= 0x30) & (chars <= 0x39)
+    is_upper = (chars >= 0x41) & (chars <= 0x5A)
+    is_word = is_digit | is_upper | ((chars >= 0x61) & (chars <= 0x7A)) | (chars == 0x5F)
+
+    # A code can start at any of the first n-4 positions: four digits, then a digit or capital.
+    m = n - 4
+    starts = is_digit[:m] & is_digit[1:m + 1] & is_digit[2:m + 2] & is_digit[3:m + 3] & (is_digit[4:] | is_upper[4:])
+    # Whole-word boundaries (\b) on both sides of the five characters.
+    starts[1:] &= ~is_word[:m - 1]
+    starts[:-1] &= ~is_word[5:]
+
+    return list({sys.intern(text_bytes[i:i + 5].decode('ascii')) for i in np.flatnonzero(starts).tolist()})
+
+def find_icd_codes(text: str) -> List[str]:
+    """
+    Finds the unique ICD-10-style codes in the text, exactly as ICD_PATTERN does.
+    Matches are collected straight into a set; ASCII text is scanned as bytes.
+    """
+    if not text.isascii():
+        return list({m.group(1) for m in ICD_PATTERN.finditer(text)})
+    return list({m.group(1).decode('ascii') for m in ICD_BYTES_PATTERN.finditer(text.encode('ascii'))})
+
 def find_best_match(pattern: re.Pattern, text: str) -> Optional[str]:
     """Finds the first match of a compiled regex pattern in the text."""
     match = pattern.search(text)
@@ -97,18 +155,7 @@ def find_best_match(pattern: re.Pattern, text: str) -> Optional[str]:
 def parse_line_items(text: str, pricing_data: Dict[str, float]) -> List[LineItem]:
     """Finds and parses all service line items in the text, now more flexible for EOBs."""
     line_items = []
-    # This regex is now designed for EOBs that may not have CPT codes.
-    # It looks for a date, some text, and a price on the same line.
-    eob_line_pattern = re.compile(
-        r"^(\d{2}/\d{2}/\d{2,4})\s+" # 1: Date
-        r".*?\s+"                      # Intermediate text we don't need
-        r"([\d,]+\.\d{2})"             # 2: Billed Amount (charges)
-        r".*?\s+"                      # More intermediate text
-        r"([\d,]+\.\d{2})$"            # 3: Patient Responsibility for this line
-        , re.MULTILINE
-    )
-
-    for match in eob_line_pattern.finditer(text):
+    for match in EOB_LINE_PATTERN.finditer(text):
         try:
             # We don't have a CPT, so we'll use the date as the key identifier
             desc = f"Service on {match.group(1)}"
@@ -140,7 +187,7 @@ def parse_bill_text(text: str, pricing_data: Dict[str, float]) -> ParsedBill:
     total_billed_str = find_best_match(TOTAL_BILLED_PATTERN, text)
     if not total_billed_str:
         # Fallback for invoices
-        total_billed_str = find_best_match(re.compile(r"Amount Due[:\s$]*([\d,]+\.\d{2})"), text)
+        total_billed_str = find_best_match(AMOUNT_DUE_PATTERN, text)
         
     patient_responsibility_str = find_best_match(PATIENT_RESPONSIBILITY_PATTERN, text)
     
@@ -153,8 +200,8 @@ def parse_bill_text(text: str, pricing_data: Dict[str, float]) -> ParsedBill:
     if patient_name and "benefits" in patient_name:
         patient_name = None
 
-    cpt_codes = list(set(CPT_PATTERN.findall(text)))
-    icd_codes = list(set(ICD_PATTERN.findall(text, re.IGNORECASE)))
+    cpt_codes = find_cpt_codes(text)
+    icd_codes = find_icd_codes(text)
     
     # If total billed is still zero, but we have a patient responsibility, use that.
     final_billed = clean_amount(total_billed_str)
@@ -184,79 +231,255 @@ def parse_bill_text(text: str, pricing_data: Dict[str, float]) -> ParsedBill:
 # --- Make sure these imports are at the top of your parser.py file ---
 from google.cloud import vision
 from google.oauth2 import service_account # New import for explicit credentials
+from google.api_core.retry import Retry
 import os
 import json
 
 # Load Google API Vision credentials if needed
 credentials_path = r"C:\bill_parser\google_api_vision.json"  # Update this path as needed
 
+def create_vision_client() -> Optional[vision.ImageAnnotatorClient]:
+    """
+    Builds the Google Vision client once at startup so the credentials file is read and
+    the gRPC channel is opened only once. Returns None if Vision is not configured.
+    """
+    if not (credentials_path and os.path.exists(credentials_path)):
+        print("INFO: Google Cloud credentials not configured or file not found. Using local extraction as default.")
+        return None
+    try:
+        # --- THIS IS THE CRITICAL FIX ---
+        # Manually load the credentials from the specified file path.
+        credentials = service_account.Credentials.from_service_account_file(credentials_path)
+        return vision.ImageAnnotatorClient(credentials=credentials)
+    except FileNotFoundError:
+        print(f"FATAL ERROR: Google credentials file not found at path: {credentials_path}. Check your .env file.")
+    except Exception as e:
+        print(f"WARNING: Could not create the Google Cloud Vision client ({e}). Using local extraction as default.")
+    return None
+
+VISION_CLIENT = create_vision_client()
+VISION_TIMEOUT_SECONDS = 30.0
+
+# Optional GCS bucket for staging PDFs. When set, PDFs are OCR'd by Vision's async batch
+# file API from a gs:// URI instead of inline bytes (base64 in the request, 10 MB cap).
+GCS_OCR_BUCKET = os.getenv("GCS_OCR_BUCKET", "")
+VISION_GCS_TIMEOUT_SECONDS = 120.0
+VISION_GCS_PAGES_PER_OUTPUT = 20  # Pages per JSON result file written back to the bucket
+VISION_GCS_OUTPUT_PATTERN = re.compile(r"output-(\d+)-to-\d+\.json$")
+
+def create_ocr_bucket():
+    """
+    Returns the GCS staging bucket (a google.cloud.storage.Bucket) for PDF OCR, or None if
+    it is not configured. google-cloud-storage is only imported when GCS_OCR_BUCKET is set,
+    so it is not required for the default inline path.
+    """
+    if not GCS_OCR_BUCKET or VISION_CLIENT is None:
+        return None
+    try:
+        from google.cloud import storage
+        credentials = service_account.Credentials.from_service_account_file(credentials_path)
+        return storage.Client(credentials=credentials, project=credentials.project_id).bucket(GCS_OCR_BUCKET)
+    except Exception as e:
+        print(f"WARNING: Could not create the GCS client for bucket '{GCS_OCR_BUCKET}' ({e}). PDFs will be sent inline.")
+    return None
+
+OCR_BUCKET = create_ocr_bucket()
+
 # --- This is the new, upgraded OCR function with explicit credential loading ---
 
-async def extract_text_from_file(file_content: bytes, content_type: str) -> str:
+# Below this many characters, a PDF's text layer is treated as missing (i.e. a scan).
+MIN_PDF_TEXT_LENGTH = 100
+# A first page with less text than this means the PDF is scanned and has to be OCR'd.
+MIN_FIRST_PAGE_TEXT_LENGTH = 30
+
+# LSTM engine only, and treat each page as a single uniform block of text (no layout analysis).
+TESSERACT_CONFIG = "--oem 1 --psm 6"
+# Tesseract runs as a subprocess, so threads are enough to OCR pages on every core.
+OCR_EXECUTOR = ThreadPoolExecutor(max_workers=os.cpu_count())
+
+# Longest side (in pixels) of an image handed to Tesseract; roughly a letter page at 200 DPI.
+OCR_MAX_DIMENSION = 2400
+
+def prepare_image_for_ocr(image: Image.Image) -> Image.Image:
     """
-    Extracts raw text from a file, prioritizing Google Vision API for high accuracy
-    and falling back to pytesseract for resilience.
+    Shrinks an image to what Tesseract actually needs: grayscale, at most
+    OCR_MAX_DIMENSION pixels on the longest side, and binarized with Otsu's threshold.
     """
-    text = ""
-    
-    # --- 1. Attempt to use Google Vision API (High Accuracy) ---
-    # Get the credentials path from the environment variable we set in .env
-    # In parser.py, inside extract_text_from_file
-    credentials_path = r"C:\bill_parser\google_api_vision.json"
-    
-    if credentials_path and os.path.exists(credentials_path):
+    image = image.convert("L")
+    if max(image.size) > OCR_MAX_DIMENSION:
+        image.thumbnail((OCR_MAX_DIMENSION, OCR_MAX_DIMENSION), Image.LANCZOS)
+
+    # Otsu: choose the gray level that maximizes the between-class variance.
+    pixels = np.asarray(image)
+    prob = np.bincount(pixels.ravel(), minlength=256) / pixels.size
+    omega = np.cumsum(prob)
+    mu = np.cumsum(prob * np.arange(256))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        between_class_variance = (mu[-1] * omega - mu) ** 2 / (omega * (1.0 - omega))
+    threshold = np.nan_to_num(between_class_variance).argmax()
+
+    return Image.fromarray(np.where(pixels > threshold, 255, 0).astype(np.uint8), "L")
+
+def ocr_image(image: Image.Image) -> str:
+    """Runs Tesseract on a single image or PDF page."""
+    return pytesseract.image_to_string(prepare_image_for_ocr(image), config=TESSERACT_CONFIG)
+
+def ocr_with_google_vision(file_content: bytes) -> str:
+    """
+    Runs Google Cloud Vision document OCR on the file. Returns an empty string on
+    any failure so the caller can fall back to the local extraction paths.
+    """
+    try:
+        print("Attempting OCR with Google Cloud Vision...")
+        image = vision.Image(content=file_content)
+        # Bound the call (retries included) so a stalled request can't hold up the OCR race.
+        response = VISION_CLIENT.document_text_detection(
+            image=image,
+            retry=Retry(deadline=VISION_TIMEOUT_SECONDS),
+            timeout=VISION_TIMEOUT_SECONDS
+        )
+
+        if response.error.message:
+            raise Exception(f"Google Vision API Error: {response.error.message}")
+
+        if response.full_text_annotation:
+            print("Google Cloud Vision OCR successful.")
+            return response.full_text_annotation.text.strip()
+    except Exception as e:
+        print(f"WARNING: Google Cloud Vision failed ({e}). Falling back to local extraction.")
+    return ""
+
+def ocr_pdf_with_google_vision_gcs(file_content: bytes) -> str:
+    """
+    OCRs a (possibly multi-page) PDF with Vision's async batch file API: the PDF is uploaded
+    once to the staging bucket, and the per-page results are read back from the JSON files
+    Vision writes there. Staged files are always deleted. Returns an empty string on failure.
+    """
+    prefix = f"ocr-tmp/{uuid.uuid4()}"
+    try:
+        print("Attempting PDF OCR with Google Cloud Vision via GCS...")
+        input_blob = OCR_BUCKET.blob(f"{prefix}/input.pdf")
+        input_blob.upload_from_string(file_content, content_type="application/pdf")
+
+        request = vision.AsyncAnnotateFileRequest(
+            features=[vision.Feature(type_=vision.Feature.Type.DOCUMENT_TEXT_DETECTION)],
+            input_config=vision.InputConfig(
+                gcs_source=vision.GcsSource(uri=f"gs://{OCR_BUCKET.name}/{input_blob.name}"),
+                mime_type="application/pdf"
+            ),
+            output_config=vision.OutputConfig(
+                gcs_destination=vision.GcsDestination(uri=f"gs://{OCR_BUCKET.name}/{prefix}/output-"),
+                batch_size=VISION_GCS_PAGES_PER_OUTPUT
+            )
+        )
+        operation = VISION_CLIENT.async_batch_annotate_files(requests=[request])
+        operation.result(timeout=VISION_GCS_TIMEOUT_SECONDS)
+
+        # Result files are named output-<first page>-to-<last page>.json; read them in page order.
+        output_blobs = [
+            (int(match.group(1)), blob)
+            for blob in OCR_BUCKET.list_blobs(prefix=f"{prefix}/output-")
+            if (match := VISION_GCS_OUTPUT_PATTERN.search(blob.name))
+        ]
+        page_texts = []
+        for _, blob in sorted(output_blobs, key=lambda item: item[0]):
+            file_response = vision.AnnotateFileResponse.from_json(blob.download_as_bytes(), ignore_unknown_fields=True)
+            page_texts.extend(page.full_text_annotation.text for page in file_response.responses)
+
+        text = "".join(page_texts).strip()
+        if text:
+            print("Google Cloud Vision PDF OCR successful.")
+        return text
+    except Exception as e:
+        print(f"WARNING: Google Cloud Vision PDF OCR via GCS failed ({e}). Falling back to local extraction.")
+        return ""
+    finally:
         try:
-            print(f"Attempting OCR with Google Cloud Vision using credentials at: {credentials_path}")
-            
-            # --- THIS IS THE CRITICAL FIX ---
-            # Manually load the credentials from the specified file path.
-            credentials = service_account.Credentials.from_service_account_file(credentials_path)
-            client = vision.ImageAnnotatorClient(credentials=credentials)
-            # --------------------------------
-            
-            image = vision.Image(content=file_content)
-            response = client.document_text_detection(image=image)
-            
-            if response.error.message:
-                raise Exception(f"Google Vision API Error: {response.error.message}")
-            
-            if response.full_text_annotation:
-                text = response.full_text_annotation.text.strip()
-                print("Google Cloud Vision OCR successful.")
-        except FileNotFoundError:
-             print(f"FATAL ERROR: Google credentials file not found at path: {credentials_path}. Check your .env file.")
-             text = "" # Ensure fallback
+            for blob in OCR_BUCKET.list_blobs(prefix=prefix):
+                blob.delete()
         except Exception as e:
-            print(f"WARNING: Google Cloud Vision failed ({e}). Falling back to pytesseract.")
-            text = "" # Ensure fallback
-    else:
-        print("INFO: Google Cloud credentials not configured or file not found. Using pytesseract as default.")
+            print(f"WARNING: Could not clean up staged OCR files under {prefix} ({e}).")
 
-    # --- 2. Fallback to pytesseract/pdfplumber ---
+def extract_pdf_text_layer(pdf_stream: BinaryIO) -> str:
+    """
+    Extracts the embedded text layer of a digital PDF with pdfplumber. If the first
+    page has (almost) no text the PDF is a scan, so the other pages are not walked.
+    """
+    try:
+        pdf_stream.seek(0)
+        with pdfplumber.open(pdf_stream) as pdf:
+            if not pdf.pages:
+                return ""
+            first_page_text = pdf.pages[0].extract_text() or ""
+            if len(first_page_text.strip()) < MIN_FIRST_PAGE_TEXT_LENGTH:
+                return ""
+            rest_text = "".join(page.extract_text() or "" for page in pdf.pages[1:])
+            return (first_page_text + rest_text).strip()
+    except Exception:
+        return ""
+
+async def extract_text_from_file(file_content: bytes, content_type: str, file_stream: Optional[BinaryIO] = None) -> str:
+    """
+    Extracts raw text from a file. Google Vision API (high accuracy) and the local
+    pdfplumber text layer are tried concurrently, falling back to pytesseract for resilience.
+    If given, `file_stream` is the upload's own file object and pdfplumber reads from it
+    directly instead of a second in-memory wrapper around `file_content`.
+    """
+    text = ""
+
+    # --- 1. Race Google Vision API against the local PDF text layer ---
+    # The Vision network round-trip overlaps with local pdfplumber extraction and the
+    # first one to return usable text wins. Candidates are listed in priority order
+    # as (task, minimum usable text length).
+    candidates = []
+    if VISION_CLIENT is not None:
+        if content_type == "application/pdf" and OCR_BUCKET is not None:
+            vision_ocr = ocr_pdf_with_google_vision_gcs
+        else:
+            vision_ocr = ocr_with_google_vision
+        vision_task = asyncio.create_task(asyncio.to_thread(vision_ocr, file_content))
+        candidates.append((vision_task, 1))
+
+    if content_type == "application/pdf":
+        pdf_stream = file_stream if file_stream is not None else io.BytesIO(file_content)
+        plumber_task = asyncio.create_task(asyncio.to_thread(extract_pdf_text_layer, pdf_stream))
+        candidates.append((plumber_task, MIN_PDF_TEXT_LENGTH))
+
+    pending = {task for task, _ in candidates}
+    while pending and not text:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task, min_length in candidates:
+            if task in done and len(task.result()) >= min_length:
+                text = task.result()
+                break
+
+    # Whichever source lost the race is no longer needed.
+    for task in pending:
+        task.cancel()
+
+    # --- 2. Fallback to pytesseract ---
     if not text:
-        # ... (The entire fallback logic for pytesseract and pdfplumber remains exactly the same) ...
-        print("Using fallback OCR (pytesseract/pdfplumber)...")
+        print("Using fallback OCR (pytesseract)...")
         if content_type == "application/pdf":
             try:
-                with pdfplumber.open(io.BytesIO(file_content)) as pdf:
-                    full_text = "".join(page.extract_text() or "" for page in pdf.pages)
-                text = full_text.strip()
-            except Exception:
-                text = ""
-
-            if len(text) < 100:
-                text = ""
-                try:
-                    images = convert_from_bytes(file_content)
-                    ocr_text = "".join(pytesseract.image_to_string(img) for img in images)
-                    text = ocr_text.strip()
-                except Exception as e:
-                    raise HTTPException(status_code=500, detail=f"PDF processing failed during OCR fallback: {e}")
+                # Tesseract only needs grayscale, and Poppler can rasterize pages on several threads.
+                # Rasterizing (Poppler subprocess + PIL decode) runs in a worker thread, off the event loop.
+                images = await asyncio.to_thread(
+                    convert_from_bytes, file_content, dpi=200, grayscale=True, fmt='jpeg', thread_count=os.cpu_count()
+                )
+                # OCR all pages in parallel off the event loop; gather keeps page order.
+                loop = asyncio.get_running_loop()
+                page_texts = await asyncio.gather(*(loop.run_in_executor(OCR_EXECUTOR, ocr_image, img) for img in images))
+                text = "".join(page_texts).strip()
+            except Exception as e:
+                raise HTTPException(status_code=500, detail=f"PDF processing failed during OCR fallback: {e}")
 
         elif content_type in ["image/jpeg", "image/png"]:
             try:
                 image = Image.open(io.BytesIO(file_content))
-                text = pytesseract.image_to_string(image).strip()
+                # Preprocessing and Tesseract run on the OCR pool, like the PDF pages.
+                loop = asyncio.get_running_loop()
+                text = (await loop.run_in_executor(OCR_EXECUTOR, ocr_image, image)).strip()
             except Exception as e:
                 raise HTTPException(status_code=500, detail=f"Image processing failed with pytesseract: {e}")
 
@@ -266,12 +489,47 @@ async def extract_text_from_file(file_content: bytes, content_type: str) -> str:
     return text
 
 # --- Load datasets into memory on application startup ---
+PRICING_CSV_PATH = "cpt_pricing_data.csv"
+PRICING_PARQUET_PATH = "cpt_pricing_data.parquet"
+
+def load_pricing_table() -> pd.DataFrame:
+    """
+    Loads the CPT pricing table, preferring the columnar Parquet cache when it is
+    at least as new as the CSV. After a CSV parse the cache is (re)written so the
+    next startup can skip it.
+    """
+    parquet_is_fresh = os.path.exists(PRICING_PARQUET_PATH) and (
+        not os.path.exists(PRICING_CSV_PATH)
+        or os.path.getmtime(PRICING_PARQUET_PATH) >= os.path.getmtime(PRICING_CSV_PATH)
+    )
+    if parquet_is_fresh:
+        try:
+            return pd.read_parquet(PRICING_PARQUET_PATH)
+        except Exception as e:
+            print(f"WARNING: Could not read {PRICING_PARQUET_PATH} ({e}). Falling back to CSV.")
+
+    pricing_df = pd.read_csv(PRICING_CSV_PATH, dtype={'cpt_code': str})
+    try:
+        pricing_df.to_parquet(PRICING_PARQUET_PATH, index=False)
+    except Exception as e:
+        print(f"WARNING: Could not write pricing cache {PRICING_PARQUET_PATH} ({e}).")
+    return pricing_df
+
 try:
-    pricing_df = pd.read_csv("cpt_pricing_data.csv", dtype={'cpt_code': str})    # Create a dictionary for fast lookups: {cpt_code: median_price}
-    PRICING_DATA = pd.Series(pricing_df.median_price.values, index=pricing_df.cpt_code).to_dict()
+    pricing_df = load_pricing_table()    # Create a dictionary for fast lookups: {cpt_code: median_price}
+    # Keys are normalized once here (stripped, upper-cased) so lookups need no per-call cleanup.
+    # Codes found by find_cpt_codes are already in this canonical form. Both sides are
+    # interned, so a lookup hash is cached and key comparison is a pointer check.
+    PRICING_DATA = {
+        sys.intern(str(code).strip().upper()): float(price)
+        for code, price in zip(pricing_df['cpt_code'].tolist(), pricing_df['median_price'].tolist())
+    }
 except FileNotFoundError:
     print("WARNING: cpt_pricing_data.csv not found. Pricing validation will be disabled.")
     PRICING_DATA = {}
+# The pricing table is static for the life of the process, so the set of billable codes
+# is built once here instead of on every /validate-bill/ request.
+VALID_CPT_CODES = frozenset(PRICING_DATA)
 # =====================================================================================
 # 5. FASTAPI APPLICATION & API ENDPOINTS
 # =====================================================================================
@@ -285,6 +543,11 @@ app = FastAPI(
 static_dir = os.path.join(os.path.dirname(__file__), "static")
 os.makedirs(static_dir, exist_ok=True) # This safely creates the 
 app.mount("/static", StaticFiles(directory=static_dir), name="static")
+
+@app.on_event("shutdown")
+async def shutdown_clients():
+    """Closes the shared outbound HTTP client used for LLM calls."""
+    await close_llm_client()
 # =====================================================================================
 @app.get("/", response_class=HTMLResponse, tags=["UI"], summary="Main User Interface")
 async def serve_ui():
@@ -318,7 +581,7 @@ async def parse_bill(file: UploadFile = File(..., description="A medical bill fi
         raise HTTPException(status_code=422, detail=f"Failed to read the uploaded file: {e}")
 
     # --- 3. Extract Text ---
-    extracted_text = await extract_text_from_file(file_content, file.content_type)
+    extracted_text = await extract_text_from_file(file_content, file.content_type, file.file)
     if not extracted_text:
         raise HTTPException(status_code=422, detail="Could not extract any text from the document. It may be empty or unreadable.")
 
@@ -329,7 +592,7 @@ async def parse_bill(file: UploadFile = File(..., description="A medical bill fi
         # This catches unexpected errors during the parsing logic itself.
         raise HTTPException(status_code=500, detail=f"An error occurred during text parsing: {e}")
     # --- 4b. Run Validations ---
-    flags = run_validations(parsed_data, PRICING_DATA) if PRICING_DATA else []
+    flags = run_validations(parsed_data, PRICING_DATA, VALID_CPT_CODES) if PRICING_DATA else []
 
     # --- 5. Return Result ---
     return ValidationResult(parsed_data=parsed_data, flags=flags)
@@ -341,11 +604,44 @@ def format_context(retrieved_docs: list[tuple[dict, float]]) -> str:
     """Helper function to format retrieved documents into a string for the prompt."""
     if not retrieved_docs:
         return "No relevant context found in the knowledge base."
-    
-    context_str = ""
-    for doc, score in retrieved_docs:
-        context_str += f"Source Content (Relevance Score: {score:.2f}):\n{doc['content']}\n\n"
-    return context_str.strip()
+
+    # One join builds the output in a single pass instead of re-growing the string per doc.
+    return "\n\n".join(
+        f"Source Content (Relevance Score: {score:.2f}):\n{doc['content']}"
+        for doc, score in retrieved_docs
+    ).strip()
+# Fields the LLM does not need. retrieval_score is the same for every flag and is already
+# folded into final_confidence, so it only costs prompt tokens.
+PROMPT_JSON_EXCLUDE = {"flags": {"__all__": {"retrieval_score"}}}
+
+def serialize_for_prompt(validation_result: ValidationResult) -> str:
+    """
+    Serializes the scored validation result for an LLM prompt: compact JSON (no indent)
+    with empty fields and PROMPT_JSON_EXCLUDE dropped, so the prompt has fewer tokens to prefill.
+    """
+    return validation_result.model_dump_json(exclude_none=True, exclude=PROMPT_JSON_EXCLUDE)
+# Citation markers the prompts ask for: "[Source: ID]" (explanations) and "(see Source: ID)"
+# (appeal letters). A marker may list several IDs separated by commas or semicolons.
+CITATION_PATTERN = re.compile(r"\[\s*Source:\s*([^\]]+)\]|\(\s*see\s+Source:\s*([^)]+)\)", re.IGNORECASE)
+CITATION_SEPARATOR_PATTERN = re.compile(r"[,;]")
+# Source IDs in the knowledge base have all whitespace removed (see rag_service), but the LLM
+# copies them from the raw chunk text, where they may be split by spaces or line breaks.
+CITATION_WHITESPACE_PATTERN = re.compile(r"\s+")
+
+def build_citations(llm_text: str, retrieved_docs: list[dict]) -> List[Citation]:
+    """
+    Builds Citation objects only for the retrieved documents the LLM actually cited,
+    so uncited context neither costs model validation nor leaks into the response.
+    IDs are taken from the citation markers and matched exactly, ignoring whitespace
+    inside the marker, so "[Source: CMS-Dup- 001]" cites "CMS-Dup-001".
+    """
+    cited_ids = {
+        CITATION_WHITESPACE_PATTERN.sub("", source_id)
+        for match in CITATION_PATTERN.finditer(llm_text)
+        for source_id in CITATION_SEPARATOR_PATTERN.split(match.group(1) or match.group(2))
+    }
+    return [Citation(**doc) for doc in retrieved_docs if doc["source"] in cited_ids]
+
 # Define the weights for our scoring algorithm
 RULE_CONFIDENCE_WEIGHT = 0.6  # The deterministic rule is the most important signal
 RETRIEVAL_SCORE_WEIGHT = 0.4  # The RAG evidence quality is the secondary signal
@@ -357,27 +653,26 @@ def calculate_final_confidence(flags: List[ValidationFlag], retrieved_docs_with_
     """
     # Find the highest relevance score from all retrieved docs. This represents
     # the "best evidence" we found for the set of flags.
-    max_retrieval_score = 0.0
-    if retrieved_docs_with_scores:
-        max_retrieval_score = max([score for doc, score in retrieved_docs_with_scores])
-
-    updated_flags = []
-    for flag in flags:
-        # Calculate the weighted average
-        final_score = (flag.rule_confidence * RULE_CONFIDENCE_WEIGHT) + (max_retrieval_score * RETRIEVAL_SCORE_WEIGHT)
-        
-        # Update the flag object with the new scores
-        flag.retrieval_score = round(max_retrieval_score, 4)
-        flag.final_confidence = round(final_score, 4)
-        updated_flags.append(flag)
+    # (A generator avoids building a temporary list; default covers "nothing retrieved".)
+    max_retrieval_score = max((score for _, score in retrieved_docs_with_scores), default=0.0)
 
-    return updated_flags
+    # Calculate the weighted average for all flags in one vectorized expression
+    rule_confidences = np.fromiter((flag.rule_confidence for flag in flags), dtype=np.float64, count=len(flags))
+    final_scores = np.round(rule_confidences * RULE_CONFIDENCE_WEIGHT + max_retrieval_score * RETRIEVAL_SCORE_WEIGHT, 4)
 
-@app.post("/explain-bill/", response_model=ExplanationResponse, tags=["LLM Services"], summary="Explain a Bill with RAG Citations")
-async def explain_bill(result: ValidationResultInput):
+    # Update the flag objects with the new scores
+    retrieval_score = round(max_retrieval_score, 4)
+    for flag, final_score in zip(flags, final_scores.tolist()):
+        flag.retrieval_score = retrieval_score
+        flag.final_confidence = final_score
+
+    return flags
+
+async def build_llm_inputs(result: ValidationResultInput) -> tuple[List[ValidationFlag], list[dict], str, str]:
     """
-    Accepts validated bill JSON, retrieves relevant context from a vector DB,
-    and uses an LLM to generate a cited explanation of the bill's issues.
+    Shared first half of every LLM endpoint: converts the input flags, retrieves RAG
+    context, scores confidence, and serializes the result for the prompt.
+    Returns (scored_flags, retrieved_docs, validation_json_str, context_str).
     """
     # --- DATA CONVERSION BRIDGE ---
     # Convert the raw input flags into the richer internal ValidationFlag format.
@@ -391,30 +686,89 @@ async def explain_bill(result: ValidationResultInput):
             final_confidence=0 # Temporary value, will be calculated next
         ) for f in result.flags
     ]
-    # --- RAG Retrieval Step ---
+
+    # --- RAG Retrieval and Confidence Scoring Step ---
     all_retrieved_docs = []
     retrieved_docs_with_scores = []
-    scored_flags = internal_flags 
-    
-    # Perform retrieval only if there are flags to investigate
+    # Default to the initial flags; they will be updated if retrieval is successful
+    scored_flags = internal_flags
+
+    # Perform retrieval and scoring only if there are flags to investigate
     if internal_flags:
-        query = " ".join([flag.message for flag in internal_flags])
-        retrieved_docs_with_scores = rag_service.retrieve_context(query)
+        # One retrieval per flag (batched), so each flag finds its own evidence. Embedding and the
+        # FAISS search are CPU-bound, so they run in a worker thread instead of blocking the event loop.
+        retrieved_docs_with_scores = await asyncio.to_thread(
+            rag_service.retrieve_context_batch, [flag.message for flag in internal_flags]
+        )
         all_retrieved_docs = [doc for doc, score in retrieved_docs_with_scores]
+
+        # Calculate the final confidence scores and update the flags
         scored_flags = calculate_final_confidence(internal_flags, retrieved_docs_with_scores)
+
     context_str = format_context(retrieved_docs_with_scores)
-    # --- LLM Composition Step ---
+
+    # Create the final, enriched object to send to the LLM.
+    # This object now contains the final, calculated confidence scores.
     final_validation_result = ValidationResult(parsed_data=result.parsed_data, flags=scored_flags)
-    validation_json_str = final_validation_result.model_dump_json(indent=2)
+    validation_json_str = serialize_for_prompt(final_validation_result)
+    return scored_flags, all_retrieved_docs, validation_json_str, context_str
+
+@app.post("/explain-bill/", response_model=ExplanationResponse, tags=["LLM Services"], summary="Explain a Bill with RAG Citations")
+async def explain_bill(result: ValidationResultInput):
+    """
+    Accepts validated bill JSON, retrieves relevant context from a vector DB,
+    and uses an LLM to generate a cited explanation of the bill's issues.
+    """
+    scored_flags, all_retrieved_docs, validation_json_str, context_str = await build_llm_inputs(result)
+
+    # --- LLM Composition Step ---
     prompt = get_explanation_prompt_with_rag(validation_json_str, context_str)
     
     explanation = await get_llm_response(prompt, SYSTEM_PROMPT)
 
-    citations = [Citation(**doc) for doc in all_retrieved_docs]
+    citations = build_citations(explanation, all_retrieved_docs)
     
     return ExplanationResponse(explanation_text=explanation, citations=citations, flags=scored_flags)
 
 
+def sse_event(data: dict) -> str:
+    """Formats one server-sent event carrying a JSON payload."""
+    return f"data: {json.dumps(data)}\n\n"
+
+@app.post("/explain-bill/stream/", tags=["LLM Services"], summary="Stream a Bill Explanation with RAG Citations")
+async def explain_bill_stream(result: ValidationResultInput):
+    """
+    Same pipeline as /explain-bill/, but the explanation is streamed back as
+    server-sent events while the LLM generates it:
+      data: {"delta": "..."}                      one per generated text chunk
+      data: {"citations": [...], "flags": [...]}  final event after the last chunk
+      data: {"error": "..."}                      sent instead if the LLM call fails
+    """
+    scored_flags, all_retrieved_docs, validation_json_str, context_str = await build_llm_inputs(result)
+
+    # --- LLM Composition Step ---
+    prompt = get_explanation_prompt_with_rag(validation_json_str, context_str)
+
+    async def event_stream() -> AsyncGenerator[str, None]:
+        explanation_parts = []
+        try:
+            async for delta in get_llm_response_stream(prompt, SYSTEM_PROMPT):
+                explanation_parts.append(delta)
+                yield sse_event({"delta": delta})
+        except HTTPException as e:
+            # The 200 status is already sent once streaming starts, so report the failure in-band.
+            yield sse_event({"error": e.detail})
+            return
+
+        citations = build_citations("".join(explanation_parts), all_retrieved_docs)
+        yield sse_event({
+            "citations": [citation.model_dump() for citation in citations],
+            "flags": [flag.model_dump() for flag in scored_flags],
+        })
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+
 # In parser.py
 
 @app.post("/draft-appeal/", response_model=AppealDraftResponse, tags=["LLM Services"], summary="Draft an Appeal Letter with RAG Citations")
@@ -423,48 +777,44 @@ async def draft_appeal(result: ValidationResultInput):
     Accepts validated bill JSON, retrieves context, and uses an LLM to
     draft a formal appeal letter strengthened with citations.
     """
-    # --- DATA CONVERSION BRIDGE ---
-    # Convert the raw input flags into the richer internal ValidationFlag format.
-    # This fixes the schema mismatch from the /validate-bill/ endpoint.
-    internal_flags = [
-        ValidationFlag(
-            flag_id=f.flag_id,
-            flag_type=f.flag_type,
-            message=f.message,
-            rule_confidence=f.confidence, # Map 'confidence' to 'rule_confidence'
-            final_confidence=0 # Temporary value, will be calculated next
-        ) for f in result.flags
-    ]
-
-    # --- RAG Retrieval and Confidence Scoring Step ---
-    all_retrieved_docs = []
-    retrieved_docs_with_scores = []
-    # Default to the initial flags; they will be updated if retrieval is successful
-    scored_flags = internal_flags
-    
-    # Perform retrieval and scoring only if there are flags to investigate
-    if internal_flags:
-        query = " ".join([flag.message for flag in internal_flags])
-        retrieved_docs_with_scores = rag_service.retrieve_context(query)
-        all_retrieved_docs = [doc for doc, score in retrieved_docs_with_scores]
-        
-        # Calculate the final confidence scores and update the flags
-        scored_flags = calculate_final_confidence(internal_flags, retrieved_docs_with_scores)
+    scored_flags, all_retrieved_docs, validation_json_str, context_str = await build_llm_inputs(result)
 
-    context_str = format_context(retrieved_docs_with_scores)
-    
     # --- LLM Composition Step ---
-    # Create the final, enriched object to send to the LLM.
-    # This object now contains the final, calculated confidence scores.
-    final_validation_result = ValidationResult(parsed_data=result.parsed_data, flags=scored_flags)
-    validation_json_str = final_validation_result.model_dump_json(indent=2)
     prompt = get_appeal_draft_prompt_with_rag(validation_json_str, context_str)
     
     appeal_draft = await get_llm_response(prompt, SYSTEM_PROMPT)
 
     # --- Create Citations for the Final Response ---
-    citations = [Citation(**doc) for doc in all_retrieved_docs]
+    citations = build_citations(appeal_draft, all_retrieved_docs)
 
     return AppealDraftResponse(appeal_draft_text=appeal_draft, citations=citations, flags=scored_flags)
 
- 
\ No newline at end of file
+
+@app.post("/analyze-bill/", response_model=AnalysisResponse, tags=["LLM Services"], summary="Explain a Bill and Draft an Appeal in One Call")
+async def analyze_bill(result: ValidationResultInput):
+    """
+    Produces both the explanation and the appeal letter for a validated bill.
+    Retrieval and confidence scoring run once, and the two LLM calls run concurrently,
+    so this takes about as long as a single /explain-bill/ call.
+    """
+    # Retrieval, scoring and serialization are shared by both prompts.
+    scored_flags, all_retrieved_docs, validation_json_str, context_str = await build_llm_inputs(result)
+
+    # --- LLM Composition Step ---
+    explain_prompt = get_explanation_prompt_with_rag(validation_json_str, context_str)
+    appeal_prompt = get_appeal_draft_prompt_with_rag(validation_json_str, context_str)
+
+    # Both round-trips overlap; the LLM latency dominates, so this halves the wall-clock time.
+    explanation, appeal_draft = await asyncio.gather(
+        get_llm_response(explain_prompt, SYSTEM_PROMPT),
+        get_llm_response(appeal_prompt, SYSTEM_PROMPT),
+    )
+
+    citations = build_citations(explanation + "\n" + appeal_draft, all_retrieved_docs)
+
+    return AnalysisResponse(
+        explanation_text=explanation,
+        appeal_draft_text=appeal_draft,
+        citations=citations,
+        flags=scored_flags,
+    )
\ No newline at end of file
@@ -0,0 +1,55 @@
+# scripts/quantize_faiss_index.py
+
+import faiss
+from langchain_community.embeddings import HuggingFaceEmbeddings
+from langchain_community.vectorstores import FAISS
+
+# --- CONFIGURATION ---
+FAISS_INDEX_PATH = "faiss_index"  # Same index the RAG service loads
+NLIST = 256      # Number of IVF clusters; each query scans only `nprobe` of them
+PQ_M = 48        # Sub-quantizers: 384-dim MiniLM vectors -> 48 bytes each (from 1536)
+PQ_NBITS = 8     # Bits per sub-quantizer code
+# FAISS wants ~39 training points per cluster; below that a flat scan is both faster and exact.
+MIN_TRAINING_VECTORS = 39 * NLIST
+
+def quantize_faiss_index():
+    """
+    Rebuilds the saved flat L2 FAISS index as a cosine-similarity index: the vectors are
+    L2-normalized and stored under the inner-product metric, so search scores are cosine
+    similarities directly. Large knowledge bases are additionally quantized as IVF-PQ;
+    small ones stay exact (IndexFlatIP). The vectors are reconstructed from the existing
+    index and re-added in the same order, so the docstore mapping stays valid.
+    """
+    print(f"Loading FAISS index from: {FAISS_INDEX_PATH}")
+    embeddings = HuggingFaceEmbeddings(model_name='all-MiniLM-L6-v2')
+    db = FAISS.load_local(FAISS_INDEX_PATH, embeddings, allow_dangerous_deserialization=True)
+
+    flat_index = db.index
+    if isinstance(flat_index, faiss.IndexIVF):
+        print("Index is already quantized. Nothing to do.")
+        return
+    if flat_index.metric_type == faiss.METRIC_INNER_PRODUCT and flat_index.ntotal < MIN_TRAINING_VECTORS:
+        print("Index already uses cosine similarity and is too small to quantize. Nothing to do.")
+        return
+
+    total_vectors = flat_index.ntotal
+    vectors = flat_index.reconstruct_n(0, total_vectors)
+    # Unit-length vectors make the inner product equal to cosine similarity.
+    faiss.normalize_L2(vectors)
+
+    if total_vectors < MIN_TRAINING_VECTORS:
+        print(f"Index has {total_vectors} vectors (< {MIN_TRAINING_VECTORS}); keeping an exact flat index.")
+        new_index = faiss.IndexFlatIP(flat_index.d)
+    else:
+        quantizer = faiss.IndexFlatIP(flat_index.d)
+        new_index = faiss.IndexIVFPQ(quantizer, flat_index.d, NLIST, PQ_M, PQ_NBITS, faiss.METRIC_INNER_PRODUCT)
+        print(f"Training IVF-PQ (nlist={NLIST}, m={PQ_M}, nbits={PQ_NBITS}) on {total_vectors} vectors...")
+        new_index.train(vectors)
+    new_index.add(vectors)
+
+    db.index = new_index
+    db.save_local(FAISS_INDEX_PATH)
+    print(f"Successfully saved cosine-similarity index to: {FAISS_INDEX_PATH}")
+
+if __name__ == "__main__":
+    quantize_faiss_index()
\ No newline at end of file
@@ -2,9 +2,70 @@
 
 from langchain_community.embeddings import HuggingFaceEmbeddings
 from langchain_community.vectorstores import FAISS
+from typing import Any, Optional
+from collections import OrderedDict
+import itertools
+import threading
+import faiss
+import numpy as np
 import re
 
 FAISS_INDEX_PATH = "faiss_index"
+EMBEDDING_CACHE_SIZE = 256  # Query embeddings memoized per exact query string
+MAX_CONTEXT_DOCS = 4  # Cap on merged chunks from a batch retrieval; all of them go into the LLM prompt
+FAISS_NPROBE = 8  # IVF clusters scanned per query when the index is quantized (quantize_faiss_index.py)
+
+# Pre-compiled once; these run on every retrieved chunk.
+SOURCE_ID_PATTERN = re.compile(r"Source ID:(.*?)Title:", re.DOTALL | re.IGNORECASE)
+WHITESPACE_PATTERN = re.compile(r"\s+")
+
+
+class SemanticCache:
+    """
+    A small in-memory cache keyed by query embeddings. A lookup hits when a stored
+    query has cosine similarity >= `threshold` with the new one, so near-identical
+    queries share one entry. Least recently used entries are evicted past `max_entries`.
+    """
+    def __init__(self, max_entries: int = 256, threshold: float = 0.95):
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self._matrix: Optional[np.ndarray] = None  # One L2-normalized query vector per row
+        self._values: list[Any] = []
+        self._last_used: list[int] = []
+        self._clock = itertools.count()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _normalize(vector) -> np.ndarray:
+        vector = np.asarray(vector, dtype=np.float32).ravel()
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def lookup(self, query_vector) -> Optional[Any]:
+        """Returns the value cached for the most similar query, or None if none is close enough."""
+        with self._lock:
+            if self._matrix is None:
+                return None
+            # One matrix-vector product scores the query against every cached entry.
+            similarities = self._matrix @ self._normalize(query_vector)
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.threshold:
+                return None
+            self._last_used[best] = next(self._clock)
+            return self._values[best]
+
+    def insert(self, query_vector, value: Any) -> None:
+        """Caches `value` under the query embedding, evicting the least recently used entry if full."""
+        row = self._normalize(query_vector)[np.newaxis, :]
+        with self._lock:
+            if self._matrix is not None and len(self._values) >= self.max_entries:
+                oldest = int(np.argmin(self._last_used))
+                self._matrix = np.delete(self._matrix, oldest, axis=0)
+                del self._values[oldest]
+                del self._last_used[oldest]
+            self._matrix = row if self._matrix is None else np.vstack([self._matrix, row])
+            self._values.append(value)
+            self._last_used.append(next(self._clock))
 
 
 class RAGService:
@@ -17,50 +78,195 @@ class RAGService:
         self.embeddings = HuggingFaceEmbeddings(model_name='all-MiniLM-L6-v2')
         
         print("Loading FAISS index...")
+        # True when the index stores normalized vectors under the inner-product metric
+        # (see quantize_faiss_index.py), so its scores are already cosine similarities.
+        self.cosine_scores = False
         try:
             self.db = FAISS.load_local(FAISS_INDEX_PATH, self.embeddings, allow_dangerous_deserialization=True)
+            # Quantized (IVF) indexes trade a little recall for speed via the number of clusters probed.
+            if hasattr(self.db.index, "nprobe"):
+                self.db.index.nprobe = FAISS_NPROBE
+            self.cosine_scores = self.db.index.metric_type == faiss.METRIC_INNER_PRODUCT
             print("FAISS index loaded successfully.")
         except Exception as e:
             print(f"CRITICAL ERROR: Could not load FAISS index. RAG features will be disabled. Error: {e}")
             self.db = None
 
+        # Flag messages repeat a lot across bills, so near-identical queries reuse earlier results.
+        self.context_cache = SemanticCache()
+        # Exact-string memo of query embeddings, least recently used first.
+        self._embedding_cache: OrderedDict[str, np.ndarray] = OrderedDict()
+        self._embedding_lock = threading.Lock()
+
+        self.warm_up()
+
+    def warm_up(self) -> None:
+        """
+        Runs one throwaway embedding and FAISS search so tokenizer/torch initialization and
+        index page-in happen at startup rather than on the first user request. Goes straight
+        to the model and index so the query and result caches are not touched.
+        """
+        print("Warming up embedding model and FAISS index...")
+        try:
+            warmup_vector = self.embeddings.embed_query("warmup")
+            if self.db is not None:
+                self.db.index.search(self.prepare_queries(warmup_vector), 1)
+        except Exception as e:
+            print(f"WARNING: RAG warm-up failed; the first request will pay the start-up cost. Error: {e}")
+
+    def embed(self, query: str) -> np.ndarray:
+        """
+        Embeds a query with the MiniLM model. Results are memoized per exact query string,
+        so e.g. explaining and then appealing the same bill costs one forward pass.
+        """
+        return self.embed_batch([query])[0]
+
+    def embed_batch(self, queries: list[str]) -> np.ndarray:
+        """
+        Embeds several queries into an (N, d) float32 matrix. Memoized queries are reused;
+        the rest go through the transformer together in one padded batch.
+        """
+        vectors: list[Optional[np.ndarray]] = []
+        misses: list[str] = []
+        with self._embedding_lock:
+            for query in queries:
+                vector = self._embedding_cache.get(query)
+                if vector is not None:
+                    self._embedding_cache.move_to_end(query)
+                else:
+                    misses.append(query)
+                vectors.append(vector)
+
+        if misses:
+            missed_vectors = dict(zip(misses, np.asarray(self.embeddings.embed_documents(misses), dtype=np.float32)))
+            with self._embedding_lock:
+                for query, vector in missed_vectors.items():
+                    self._embedding_cache[query] = vector
+                    self._embedding_cache.move_to_end(query)
+                while len(self._embedding_cache) > EMBEDDING_CACHE_SIZE:
+                    self._embedding_cache.popitem(last=False)
+            vectors = [missed_vectors[query] if vector is None else vector for query, vector in zip(queries, vectors)]
+
+        return np.stack(vectors)
+
+    def prepare_queries(self, query_vectors: np.ndarray) -> np.ndarray:
+        """Returns the (N, d) query matrix as float32, L2-normalized when the index scores by cosine similarity."""
+        query_vectors = np.array(query_vectors, dtype=np.float32, ndmin=2)
+        if self.cosine_scores:
+            faiss.normalize_L2(query_vectors)
+        return query_vectors
+
+    def to_similarity(self, score: float) -> float:
+        """
+        Converts a raw FAISS score to the similarity the app uses (higher is better).
+        Cosine indexes already return it; legacy L2 indexes return a distance that is
+        squashed into (0, 1] instead.
+        """
+        if self.cosine_scores:
+            return score
+        return 1.0 / (1.0 + score)
+
     # THIS FUNCTION IS NOW CORRECTLY INDENTED AS A METHOD OF THE CLASS
     def retrieve_context(self, query: str, k: int = 2) -> list[tuple[dict, float]]:
         """
         Retrieves the top-k most relevant document chunks for a given query.
-        Returns a list of tuples, each containing the document metadata and a normalized similarity score (0 to 1).
+        Returns a list of tuples, each containing the document metadata and a similarity score
+        (cosine similarity for normalized inner-product indexes, 0 to 1 for legacy L2 indexes).
+        """
+        if self.db is None:
+            return []
+        try:
+            return self.retrieve_by_vector(self.embed(query), k=k)
+        except Exception as e:
+            print(f"ERROR during RAG retrieval: {e}")
+            return []
+
+    def retrieve_by_vector(self, query_vector: np.ndarray, k: int = 2) -> list[tuple[dict, float]]:
+        """
+        Same as retrieve_context, for a query that has already been embedded with `embed`.
         """
         if self.db is None:
             return []
         
         try:
-            # Use the more fundamental function that returns L2 distance (lower is better).
-            results_with_scores = self.db.similarity_search_with_score(query, k=k)
-            
-            formatted_results = []
-            for doc, score in results_with_scores:
-                # Manually normalize the distance score to a similarity score (0 to 1, higher is better).
-                similarity_score = 1.0 / (1.0 + score)
-
-                clean_source_id = "Unknown"
-                # Robust regex parser for the source ID
-                match = re.search(r"Source ID:(.*?)Title:", doc.page_content, re.DOTALL | re.IGNORECASE)
-                if match:
-                    raw_id = match.group(1)
-                    clean_source_id = re.sub(r'\s+', '', raw_id)
-
-                result_item = {
-                    "content": doc.page_content,
-                    "source": clean_source_id
-                }
-
-                # Crucially, cast the final score to a standard Python float to prevent serialization errors.
-                formatted_results.append((result_item, float(similarity_score)))
-
-            return formatted_results
+            return self.search_vectors(np.asarray(query_vector)[np.newaxis, :], k=k)[0]
         except Exception as e:
             print(f"ERROR during RAG retrieval: {e}")
             return []
 
+    def search_vectors(self, query_vectors: np.ndarray, k: int = 2) -> list[list[tuple[dict, float]]]:
+        """
+        Returns the top-k results for each row of an (N, d) matrix of embedded queries.
+        Each query is first looked up in the semantic cache; only the misses are sent to
+        FAISS, together in one search, and their results are cached.
+        """
+        results: list[Optional[list[tuple[dict, float]]]] = []
+        misses: list[int] = []
+        for i, query_vector in enumerate(query_vectors):
+            cached = self.context_cache.lookup(query_vector)
+            if cached is not None and cached[0] == k:
+                results.append(list(cached[1]))
+            else:
+                results.append(None)
+                misses.append(i)
+
+        if misses:
+            scores, indices = self.db.index.search(self.prepare_queries(query_vectors[misses]), k)
+            for i, row_scores, row_indices in zip(misses, scores.tolist(), indices.tolist()):
+                formatted_results = []
+                for score, index in zip(row_scores, row_indices):
+                    if index == -1:  # FAISS pads with -1 when the index holds fewer than k chunks
+                        continue
+                    doc = self.db.docstore.search(self.db.index_to_docstore_id[index])
+                    formatted_results.append(self.format_result(doc, self.to_similarity(score)))
+                self.context_cache.insert(query_vectors[i], (k, formatted_results))
+                results[i] = formatted_results
+
+        return results
+
+    def retrieve_context_batch(self, queries: list[str], k: int = 2, max_docs: int = MAX_CONTEXT_DOCS) -> list[tuple[dict, float]]:
+        """
+        Retrieves the top-k chunks for each query separately, but with one batched
+        embedding pass and one FAISS search for the queries not already cached.
+        Chunks found by several queries are returned once, with their best score,
+        ordered from most to least relevant and capped at the top `max_docs`, so a bill
+        with many flags does not flood the prompt.
+        """
+        if self.db is None or not queries:
+            return []
+
+        try:
+            unique_queries = list(dict.fromkeys(queries))
+            per_query_results = self.search_vectors(self.embed_batch(unique_queries), k=k)
+
+            best_results: dict[str, tuple[dict, float]] = {}
+            for doc, score in itertools.chain.from_iterable(per_query_results):
+                best = best_results.get(doc["content"])
+                if best is None or score > best[1]:
+                    best_results[doc["content"]] = (doc, score)
+
+            return sorted(best_results.values(), key=lambda item: item[1], reverse=True)[:max_docs]
+        except Exception as e:
+            print(f"ERROR during batched RAG retrieval: {e}")
+            return []
+
+    @staticmethod
+    def format_result(doc, similarity_score: float) -> tuple[dict, float]:
+        """Turns a retrieved LangChain document and its similarity into the (metadata, score) pair the app uses."""
+        clean_source_id = "Unknown"
+        # Robust regex parser for the source ID
+        match = SOURCE_ID_PATTERN.search(doc.page_content)
+        if match:
+            raw_id = match.group(1)
+            clean_source_id = WHITESPACE_PATTERN.sub('', raw_id)
+
+        result_item = {
+            "content": doc.page_content,
+            "source": clean_source_id
+        }
+
+        # Crucially, cast the final score to a standard Python float to prevent serialization errors.
+        return result_item, float(similarity_score)
+
 # Create a single, global instance of the RAG service to be used by the app
 rag_service = RAGService()
\ No newline at end of file
@@ -1,14 +1,15 @@
 # validator.py
 
-from typing import List, Dict
+from typing import List, Dict, Tuple, Optional, AbstractSet
+import numpy as np
 # We need to import the models from our main parser file
 from models import ParsedBill, ValidationFlag
 
 # --- RULE 1: Check for Missing Claim ID ---
-def check_missing_claim_id(parsed_bill: ParsedBill) -> ValidationFlag | None:
+def check_missing_claim_id(parsed_bill: ParsedBill, raw_text_lower: str) -> ValidationFlag | None:
     """Flags bills that are likely EOBs but are missing a claim ID."""
     # This heuristic can be improved, e.g., by checking for "Explanation of Benefits" in raw_text
-    is_eob = "eob" in parsed_bill.raw_text.lower() or "explanation of benefits" in parsed_bill.raw_text.lower()
+    is_eob = "eob" in raw_text_lower or "explanation of benefits" in raw_text_lower
     
     if is_eob and not parsed_bill.claim_id:
         return ValidationFlag(
@@ -23,115 +24,120 @@ def check_missing_claim_id(parsed_bill: ParsedBill) -> ValidationFlag | None:
 # In validator.py
 
 # --- RULE 2 (REVISED): Check for Outlier Pricing on a Line-Item Basis ---
-def check_outlier_pricing(parsed_bill: ParsedBill, pricing_data: Dict[str, float]) -> List[ValidationFlag]:
+def outlier_indices(amounts: np.ndarray, medians: np.ndarray, threshold: float) -> np.ndarray:
+    """
+    Numeric kernel of the outlier rule: returns the indices where the billed amount
+    exceeds threshold x the median price (and the median is positive).
+    Pure float64 arrays in, int64 indices out, no Python objects touched.
+    """
+    # (median > 0 also avoids division by zero on invalid pricing data; NaN never passes.)
+    return np.flatnonzero((medians > 0) & (amounts > medians * threshold))
+
+def check_outlier_pricing(codes: np.ndarray, amounts: np.ndarray, pricing_data: Dict[str, float]) -> List[ValidationFlag]:
     """
     Flags individual CPT codes with billed amounts far exceeding the median price.
-    This rule is robust and works on a per-line-item basis.
+    This rule is robust and works on a per-line-item basis, using the line-item
+    arrays from `line_item_arrays` so the comparison runs as one vectorized pass.
     """
     flags = []
     OVERCHARGE_THRESHOLD = 5.0  # Flag if billed amount is > 5x the median.
 
     # Pre-condition: This check is impossible without parsed line items.
-    if not parsed_bill.line_items:
+    if codes.size == 0:
         return flags
 
-    # Iterate through each service line we found on the bill.
-    for item in parsed_bill.line_items:
-        # --- Robustness Check 1: Ensure the line item is usable ---
-        # Skip any line items where the CPT code or amount couldn't be parsed.
-        if not item.cpt_code or item.billed_amount is None:
-            continue
-
-        # --- Robustness Check 2: Ensure we have pricing data for this code ---
-        if item.cpt_code in pricing_data:
-            median_price = pricing_data[item.cpt_code]
+    # --- Robustness Checks: Line items without a code, an amount, or pricing data get NaN,
+    # and NaN never passes the comparisons below, so those items are skipped automatically.
+    medians = np.array([pricing_data.get(code, np.nan) for code in codes], dtype=np.float64)
 
-            # --- Robustness Check 3: Avoid division by zero or invalid data ---
-            if median_price <= 0:
-                continue
+    # --- The Core Logic: Compare every line item's price to its median at once ---
+    outliers = outlier_indices(amounts, medians, OVERCHARGE_THRESHOLD)
 
-            # --- The Core Logic: Compare the line item's price to the median ---
-            if item.billed_amount > (median_price * OVERCHARGE_THRESHOLD):
-                # Calculate the multiplier to create a more helpful message.
-                times_median = item.billed_amount / median_price
+    # Build flags only for the (few) line items that were actually flagged.
+    for i in outliers.tolist():
+        billed_amount = float(amounts[i])
+        median_price = float(medians[i])
+        # Calculate the multiplier to create a more helpful message.
+        times_median = billed_amount / median_price
 
-                # Create a highly specific and actionable flag.
-                
-                flags.append(ValidationFlag(
-                    flag_id="outlier_pricing_line_item",
-                    flag_type="warning",
-                    message=(
-                        f"Line item for CPT {item.cpt_code} billed at ${item.billed_amount:,.2f} "
-                        f"is ~{times_median:.1f}x the median price of ${median_price:,.2f}."
-                    ),
-                    # --- THIS IS THE CRITICAL FIX ---
-                    # Provide the required base confidence. The final score will be calculated later.
-                    rule_confidence=0.90,
-                    final_confidence=0  # Provide a temporary default value.
-                ))
+        # Create a highly specific and actionable flag.
+        flags.append(ValidationFlag(
+            flag_id="outlier_pricing_line_item",
+            flag_type="warning",
+            message=(
+                f"Line item for CPT {codes[i]} billed at ${billed_amount:,.2f} "
+                f"is ~{times_median:.1f}x the median price of ${median_price:,.2f}."
+            ),
+            # --- THIS IS THE CRITICAL FIX ---
+            # Provide the required base confidence. The final score will be calculated later.
+            rule_confidence=0.90,
+            final_confidence=0  # Provide a temporary default value.
+        ))
     return flags
 # --- RULE 3: Check for Common Denial Reasons ---
-def check_denial_reasons(parsed_bill: ParsedBill) -> List[ValidationFlag]:
-    """Scans the raw text for keywords indicating a claim denial."""
-    flags = []
-    
-    # A list of common denial phrases. This can be expanded.
-    # We use lowercase to make the search case-insensitive.
-    DENIAL_KEYWORDS = [
-        "denied",
-        "denial",
-        "not covered",
-        "not a covered benefit",
-        "lack of documentation",
-        "out of network",
-        "prior authorization required",
-        "service not medically necessary"
-    ]
-
-    raw_text_lower = parsed_bill.raw_text.lower()
-
-    for keyword in DENIAL_KEYWORDS:
-        if keyword in raw_text_lower:
-            flags.append(ValidationFlag(
-                flag_id="denial_reason_found",
-                flag_type="critical", # This is a more severe flag
-                rule_confidence=0.98,
-                message=f"Potential denial detected. Found keyword: '{keyword}'."
-            ))
-
-    # To avoid returning multiple flags for the same denial, we'll return only the first one found.
-    # In a more advanced system, you might group them.
-    return flags[:1]
-def check_duplicates(parsed_bill: ParsedBill) -> List[ValidationFlag]:
+# A list of common denial phrases, in reporting priority order. This can be expanded.
+# We use lowercase to make the search case-insensitive.
+DENIAL_KEYWORDS = [
+    "denied",
+    "denial",
+    "not covered",
+    "not a covered benefit",
+    "lack of documentation",
+    "out of network",
+    "prior authorization required",
+    "service not medically necessary"
+]
+def check_denial_reasons(raw_text_lower: str) -> List[ValidationFlag]:
+    """Scans the (lowercased) raw text for keywords indicating a claim denial."""
+    # To avoid returning multiple flags for the same denial, we report only the first
+    # keyword (in list order) that is present. Each `in` is a fast C substring search.
+    keyword = next((k for k in DENIAL_KEYWORDS if k in raw_text_lower), None)
+    if keyword is None:
+        return []
+
+    return [ValidationFlag(
+        flag_id="denial_reason_found",
+        flag_type="critical", # This is a more severe flag
+        rule_confidence=0.98,
+        message=f"Potential denial detected. Found keyword: '{keyword}'."
+    )]
+def check_duplicates(codes: np.ndarray, amounts: np.ndarray) -> List[ValidationFlag]:
     """Finds duplicate line items (same CPT and billed amount)."""
     flags = []
-    seen_items = set()
 
     # We need at least 2 line items to have a duplicate
-    if len(parsed_bill.line_items) < 2:
+    if codes.size < 2:
         return flags
 
-    for item in parsed_bill.line_items:
-        # A unique identifier for a line item is its code and price
-        # We skip items where parsing might have failed
-        if not item.cpt_code or item.billed_amount is None:
-            continue
-
-        item_tuple = (item.cpt_code, item.billed_amount)
-        
-        if item_tuple in seen_items:
-            # We've seen this exact item before, it's a duplicate
-            flags.append(ValidationFlag(
-                flag_id="duplicate_line_item",
-                flag_type="error", # Duplicates are a serious issue
-                rule_confidence=1.0, # This is a deterministic check
-                message=f"Duplicate line item found: CPT {item.cpt_code} for ${item.billed_amount:,.2f}."
-            ))
-        else:
-            seen_items.add(item_tuple)
+    # A unique identifier for a line item is its code and price
+    # We skip items where parsing might have failed
+    usable = np.flatnonzero(np.array([bool(code) for code in codes]) & ~np.isnan(amounts))
+    if usable.size < 2:
+        return flags
+
+    # Sort the (code id, exact amount) pairs with one lexsort. It is stable, so within each
+    # run of equal pairs the items stay in bill order and the first one is the original.
+    _, code_ids = np.unique(codes[usable].astype(str), return_inverse=True)
+    usable_amounts = amounts[usable]
+    order = np.lexsort((usable_amounts, code_ids))
+    sorted_codes = code_ids[order]
+    sorted_amounts = usable_amounts[order]
+    is_repeat = np.zeros(order.size, dtype=bool)
+    is_repeat[1:] = (sorted_codes[1:] == sorted_codes[:-1]) & (sorted_amounts[1:] == sorted_amounts[:-1])
+
+    # Every later occurrence of an already-seen pair is a duplicate, reported in bill order.
+    is_duplicate = np.zeros(usable.size, dtype=bool)
+    is_duplicate[order[is_repeat]] = True
+    for i in usable[is_duplicate].tolist():
+        flags.append(ValidationFlag(
+            flag_id="duplicate_line_item",
+            flag_type="error", # Duplicates are a serious issue
+            rule_confidence=1.0, # This is a deterministic check
+            message=f"Duplicate line item found: CPT {codes[i]} for ${float(amounts[i]):,.2f}."
+        ))
     
     return flags
-def check_invalid_cpt_codes(parsed_bill: ParsedBill, valid_codes: set) -> List[ValidationFlag]:
+def check_invalid_cpt_codes(parsed_bill: ParsedBill, valid_codes: AbstractSet[str]) -> List[ValidationFlag]:
     """Flags any CPT code that does not exist in the official fee schedule."""
     flags = []
     if not parsed_bill.line_items:
@@ -147,31 +153,55 @@ def check_invalid_cpt_codes(parsed_bill: ParsedBill, valid_codes: set) -> List[V
                 message=f"Invalid or non-billable CPT code found: {item.cpt_code}."
             ))
     return flags
+def line_item_arrays(parsed_bill: ParsedBill) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Converts the bill's line items into parallel arrays (one attribute pass over the
+    objects) for the vectorized rules: CPT codes as an object array (None when missing)
+    and billed amounts as float64 (NaN when missing).
+    """
+    items = parsed_bill.line_items
+    codes = np.array([item.cpt_code for item in items], dtype=object)
+    amounts = np.array(
+        [np.nan if item.billed_amount is None else item.billed_amount for item in items],
+        dtype=np.float64
+    )
+    return codes, amounts
+
 # --- Main Orchestrator ---
-def run_validations(parsed_bill: ParsedBill, pricing_data: Dict[str, float]) -> List[ValidationFlag]:
+def run_validations(
+    parsed_bill: ParsedBill,
+    pricing_data: Dict[str, float],
+    valid_cpt_codes: Optional[AbstractSet[str]] = None
+) -> List[ValidationFlag]:
     """
     Runs all configured validation rules and returns a list of flags.
+    Pass valid_cpt_codes (built once at startup from pricing_data) to avoid
+    rebuilding the code set on every call.
     """
     all_flags = []
-    valid_cpt_codes_set = set(pricing_data.keys())
+    if valid_cpt_codes is None:
+        valid_cpt_codes = frozenset(pricing_data)
+    codes, amounts = line_item_arrays(parsed_bill)
+    # Lowercase the (possibly tens of KB) bill text once and share it between the text rules.
+    raw_text_lower = parsed_bill.raw_text.lower()
 
     # Run Rule 1
-    flag1 = check_missing_claim_id(parsed_bill)
+    flag1 = check_missing_claim_id(parsed_bill, raw_text_lower)
     if flag1:
         all_flags.append(flag1)
 
     # Run Rule 2
-    flags2 = check_outlier_pricing(parsed_bill, pricing_data)
+    flags2 = check_outlier_pricing(codes, amounts, pricing_data)
     all_flags.extend(flags2)
     
     # --- ADD THIS SECTION FOR THE NEW RULE ---
     # Run Rule 3
-    flags3 = check_denial_reasons(parsed_bill)
+    flags3 = check_denial_reasons(raw_text_lower)
     all_flags.extend(flags3)
-    flags4 = check_duplicates(parsed_bill)
+    flags4 = check_duplicates(codes, amounts)
     all_flags.extend(flags4)
     # ----------------------------------------
-    flags5 = check_invalid_cpt_codes(parsed_bill, valid_cpt_codes_set)
+    flags5 = check_invalid_cpt_codes(parsed_bill, valid_cpt_codes)
     all_flags.extend(flags5)
 
     return all_flags
\ No newline at end of file